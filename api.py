@@ -1,8 +1,11 @@
+import json
+import os
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, HttpUrl
 from typing import Optional, Dict, Any
-from infer import process_legal_document
+from infer import process_legal_document, stream_legal_document
 
 app = FastAPI(
     title="Legal Document Analysis API",
@@ -43,7 +46,7 @@ async def analyze_legal_document(request: LegalDocumentRequest):
     try:
         pdf_url = str(request.pdf_url)
 
-        result = process_legal_document(pdf_url)
+        result = await process_legal_document(pdf_url)
 
         if result["status"] == "error":
             raise HTTPException(status_code=400, detail=result["message"])
@@ -56,6 +59,17 @@ async def analyze_legal_document(request: LegalDocumentRequest):
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+@app.post("/analyze-legal-document/stream")
+async def analyze_legal_document_stream(request: LegalDocumentRequest):
+    pdf_url = str(request.pdf_url)
+
+    async def event_stream():
+        async for event in stream_legal_document(pdf_url):
+            yield f"data: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @app.get("/")
 async def root():
     return {
@@ -64,6 +78,27 @@ async def root():
         "endpoints": {
             "health": "/health",
             "legal_analysis": "/analyze-legal-document",
+            "legal_analysis_stream": "/analyze-legal-document/stream",
         },
     }
 
+
+if __name__ == "__main__":
+    import importlib.util
+
+    from hypercorn.config import Config
+    from hypercorn.run import run
+
+    config = Config()
+    config.application_path = "api:app"
+    config.bind = [f"0.0.0.0:{os.getenv('PORT', '8000')}"]
+    config.workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    config.worker_class = (
+        "uvloop" if importlib.util.find_spec("uvloop") is not None else "asyncio"
+    )
+    # workers must not be daemonic so they can start the PDF process pool,
+    # which is sized to their share of the CPUs to avoid workers x CPUs processes
+    config.daemon = False
+    pool_workers = (os.cpu_count() or 1) // max(1, config.workers)
+    os.environ.setdefault("PDF_POOL_WORKERS", str(max(1, pool_workers)))
+    run(config)
@@ -1,9 +1,22 @@
 import pdfplumber
+import pymupdf
+import asyncio
+import atexit
+import hashlib
+import http.cookiejar
+import io
 import math
+import multiprocessing
+import re
 import requests
+import tempfile
+import threading
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from google import genai
 from google.genai import types
-from typing import List, Dict
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 import os
 from dotenv import load_dotenv
 
@@ -11,122 +24,354 @@ load_dotenv()
 
 TOKEN_LIMIT_LEGAL = 128_000
 MODEL_NAME_LEGAL = "gemma-3-27b-it"
+MAX_CONCURRENT_LEGAL = int(os.getenv("MAX_CONCURRENT_LEGAL", "4"))
+# each request gets a single ~8K-token answer, so only pack as many 30k-char
+# excerpts as that answer can still explain properly
+MAX_EXCERPTS_PER_REQUEST = int(os.getenv("MAX_EXCERPTS_PER_REQUEST", "2"))
+
+LEGAL_SYSTEM_PROMPT = (
+    "You are a helpful assistant that explains legal documents in plain, "
+    "bite-sized bulleted chunks. Demystify technical/legal language while "
+    "preserving the legal meaning and any obligations. Flag ambiguous parts "
+    "or items that need human/legal review."
+)
+LEGAL_TASK = (
+    "Task: Explain each excerpt above in simple, bite-sized bullet points, "
+    "under a heading naming its excerpt number. "
+    "For each bullet, indicate if it references clause numbers, parties, deadlines, "
+    "or obligations. If a section requires special attention or a lawyer, say so. "
+    "Finish each excerpt with a short plain-English summary of it."
+)
+# Gemma models on the Gemini API reject system_instruction; for them the prompt
+# goes out as the identical leading part of every request instead
+LEGAL_CONFIG = (
+    None
+    if MODEL_NAME_LEGAL.startswith("gemma")
+    else types.GenerateContentConfig(system_instruction=LEGAL_SYSTEM_PROMPT)
+)
+
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", os.cpu_count() or 1))
+MIN_CHARS_PER_PAGE = 10
+# text past ~10% over the token limit would only be split off, so stop reading there
+MAX_EXTRACT_CHARS = int(TOKEN_LIMIT_LEGAL * 4 * 1.1)
+
+LEGAL_CACHE_ENABLED = os.getenv("LEGAL_CACHE_ENABLED", "true").lower() == "true"
+LEGAL_CACHE_SIZE = int(os.getenv("LEGAL_CACHE_SIZE", "128"))
+
+_LEGAL_CACHE: "OrderedDict[str, Dict[str, any]]" = OrderedDict()
+
+_CLIENT = None
+# shared by every request in the process, since Gemini's quota is per key
+_LEGAL_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_LEGAL)
+_PDF_POOL = None
+_PDF_POOL_LOCK = threading.Lock()
+_CHUNK_RE: Dict[int, "re.Pattern[str]"] = {}
+
+_SESSION = requests.Session()
+_SESSION.headers.update(
+    {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+)
+_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+# the session is shared by all callers, so never keep one caller's cookies
+_SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+atexit.register(_SESSION.close)
 
 
 def get_gemini_client():
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise ValueError("GEMINI_API_KEY not found in environment variables")
-    return genai.Client(api_key=api_key)
+    global _CLIENT
+    if _CLIENT is None:
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY not found in environment variables")
+        _CLIENT = genai.Client(api_key=api_key)
+    return _CLIENT
 
 
-def download_pdf(url: str, local_path: str = "temp_document.pdf") -> str:
+def download_pdf(url: str) -> bytes:
     try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-        }
-        response = requests.get(url, headers=headers, timeout=30)
+        headers = {"Accept-Encoding": "identity"}
+        response = _SESSION.get(url, headers=headers, timeout=30)
         response.raise_for_status()
-
-        with open(local_path, "wb") as f:
-            f.write(response.content)
-        return local_path
+        return response.content
     except Exception as e:
         raise Exception(f"Failed to download PDF: {str(e)}")
 
 
-def read_pdf_to_text(path: str) -> str:
-    parts = []
+def get_pdf_pool() -> Optional[ProcessPoolExecutor]:
+    global _PDF_POOL
+    # daemonic processes (hypercorn's default workers) may not have children
+    if multiprocessing.current_process().daemon:
+        return None
+    with _PDF_POOL_LOCK:
+        if _PDF_POOL is None:
+            # forking a process that already runs threads can deadlock the child
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn"
+            )
+            _PDF_POOL = ProcessPoolExecutor(
+                max_workers=PDF_POOL_WORKERS, mp_context=context
+            )
+    return _PDF_POOL
+
+
+def _extract_pages_text(path: str, page_indices: List[int]) -> List[str]:
+    # pdfplumber objects can't be pickled, so each worker reopens the file
     with pdfplumber.open(path) as pdf:
-        for page in pdf.pages:
-            txt = page.extract_text()
+        return [pdf.pages[i].extract_text() or "" for i in page_indices]
+
+
+def read_pdf_to_text(data: bytes, max_chars: Optional[int] = None) -> Tuple[str, int]:
+    parts = []
+    total_chars = 0
+    pages_skipped = 0
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        for page_index, page in enumerate(doc):
+            if max_chars is not None and total_chars > max_chars:
+                pages_skipped = doc.page_count - page_index
+                break
+            txt = page.get_text("text")
             if txt:
                 parts.append(txt)
-    return "\n\n".join(parts)
+                total_chars += len(txt)
+        pages_read = doc.page_count - pages_skipped
+    text = "\n\n".join(parts)
+    if len(text.strip()) >= MIN_CHARS_PER_PAGE * pages_read:
+        return text, pages_skipped
+    # MuPDF found next to nothing (e.g. only page numbers); give pdfplumber's
+    # layout analysis a try
+    return read_pdf_to_text_pdfplumber(data), 0
+
+
+def read_pdf_to_text_pdfplumber(data: bytes) -> str:
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        page_count = len(pdf.pages)
+
+    pool = get_pdf_pool()
+    if page_count <= 1 or pool is None:
+        with pdfplumber.open(io.BytesIO(data)) as pdf:
+            parts = [page.extract_text() or "" for page in pdf.pages]
+        return "\n\n".join(txt for txt in parts if txt)
+
+    # spill to a per-call temp file so workers read it from disk instead of
+    # each being sent a pickled copy of the document
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        workers = min(PDF_POOL_WORKERS, page_count)
+        batches = [list(range(page_count))[w::workers] for w in range(workers)]
+        results = pool.map(_extract_pages_text, [path] * workers, batches)
+        parts = [""] * page_count
+        for batch, texts in zip(batches, results):
+            for i, txt in zip(batch, texts):
+                parts[i] = txt
+    finally:
+        os.unlink(path)
+    return "\n\n".join(txt for txt in parts if txt)
 
 
 def chunk_text(text: str, chunk_size: int = 30000) -> List[str]:
-    chunks = []
-    i = 0
-    L = len(text)
-    while i < L:
-        end = min(i + chunk_size, L)
-        if end < L:
-            next_space = text.find(" ", end)
-            if next_space != -1 and next_space - i <= chunk_size * 1.2:
-                end = next_space
-        chunks.append(text[i:end].strip())
-        i = end
+    chunk_re = _CHUNK_RE.get(chunk_size)
+    if chunk_re is None:
+        # prefer a break at whitespace; hard-split runs with no whitespace
+        chunk_re = re.compile(r"(.{1,%d})(?:\s|$)|(.{%d})" % (chunk_size, chunk_size), re.S)
+        _CHUNK_RE[chunk_size] = chunk_re
+    chunks = [(m.group(1) or m.group(2)).strip() for m in chunk_re.finditer(text)]
     return [c for c in chunks if c]
 
 
+def cache_get(key: str):
+    if not LEGAL_CACHE_ENABLED or key not in _LEGAL_CACHE:
+        return None
+    _LEGAL_CACHE.move_to_end(key)
+    return _LEGAL_CACHE[key]
+
+
+def cache_put(key: str, result: Dict[str, any]) -> None:
+    if not LEGAL_CACHE_ENABLED:
+        return
+    _LEGAL_CACHE[key] = result
+    _LEGAL_CACHE.move_to_end(key)
+    while len(_LEGAL_CACHE) > LEGAL_CACHE_SIZE:
+        _LEGAL_CACHE.popitem(last=False)
+
+
 def approx_tokens_from_chars(text: str, chars_per_token: float = 4.0) -> int:
     return max(1, math.ceil(len(text) / chars_per_token))
 
 
-def process_legal_document(pdf_url: str) -> Dict[str, any]:
+def format_excerpt(idx: int, total: int, chunk: str) -> str:
+    return f"Excerpt {idx} of {total}:\n\n{chunk}"
+
+
+def batch_chunks(
+    chunks: List[str],
+    token_limit: int = TOKEN_LIMIT_LEGAL,
+    max_excerpts: int = MAX_EXCERPTS_PER_REQUEST,
+) -> List[List[Tuple[int, str]]]:
+    budget = token_limit - approx_tokens_from_chars(LEGAL_SYSTEM_PROMPT + LEGAL_TASK)
+    batches = []
+    current = []
+    current_tokens = 0
+    for idx, chunk in enumerate(chunks, start=1):
+        tokens = approx_tokens_from_chars(format_excerpt(idx, len(chunks), chunk))
+        if current and (
+            current_tokens + tokens > budget or len(current) >= max_excerpts
+        ):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append((idx, chunk))
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_legal_content(excerpts: List[Tuple[int, str]], total: int) -> types.Content:
+    parts = []
+    if LEGAL_CONFIG is None:
+        parts.append(types.Part.from_text(text=LEGAL_SYSTEM_PROMPT))
+    for idx, chunk in excerpts:
+        parts.append(types.Part.from_text(text=format_excerpt(idx, total, chunk)))
+    parts.append(types.Part.from_text(text=LEGAL_TASK))
+    return types.Content(role="user", parts=parts)
+
+
+async def prepare_legal_document(pdf_url: str) -> Dict[str, any]:
+    pdf_bytes = await asyncio.to_thread(download_pdf, pdf_url)
+
+    cache_key = hashlib.sha256(pdf_bytes).hexdigest()
+    cached = cache_get(cache_key)
+    if cached is not None:
+        return {"cache_key": cache_key, "cached": cached}
+
+    pdf_text, pages_skipped = await asyncio.to_thread(
+        read_pdf_to_text, pdf_bytes, MAX_EXTRACT_CHARS
+    )
+
+    if not pdf_text.strip():
+        raise ValueError("No text extracted from the PDF.")
+
+    estimated_tokens = approx_tokens_from_chars(pdf_text)
+
+    if estimated_tokens > TOKEN_LIMIT_LEGAL:
+        chunks = chunk_text(pdf_text, chunk_size=30000)
+    else:
+        chunks = [pdf_text]
+
+    return {
+        "cache_key": cache_key,
+        "cached": None,
+        "estimated_tokens": estimated_tokens,
+        "pages_skipped": pages_skipped,
+        "chunks": chunks,
+        "batches": batch_chunks(chunks),
+    }
+
+
+def build_legal_result(prepared: Dict[str, any], responses: List[str]) -> Dict[str, any]:
+    estimated_tokens = prepared["estimated_tokens"]
+    return {
+        "status": "success",
+        "explanation": "\n\n".join(responses),
+        "metadata": {
+            "estimated_tokens": estimated_tokens,
+            "chunks_processed": len(prepared["chunks"]),
+            "requests_made": len(prepared["batches"]),
+            "pages_skipped": prepared["pages_skipped"],
+            "within_token_limit": estimated_tokens <= TOKEN_LIMIT_LEGAL,
+        },
+    }
+
+
+async def process_legal_document(pdf_url: str) -> Dict[str, any]:
     try:
         client = get_gemini_client()
 
-        local_pdf_path = download_pdf(pdf_url)
-
-        pdf_text = read_pdf_to_text(local_pdf_path)
-
-        if not pdf_text.strip():
-            return {
-                "status": "error",
-                "message": "No text extracted from the PDF.",
-                "explanation": None,
-            }
-
-        estimated_tokens = approx_tokens_from_chars(pdf_text)
-
-        if estimated_tokens > TOKEN_LIMIT_LEGAL:
-            chunks = chunk_text(pdf_text, chunk_size=30000)
-        else:
-            chunks = [pdf_text]
-
-        all_responses = []
-        for idx, chunk in enumerate(chunks, start=1):
-            user_content = types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(
-                        text=(
-                            "You are a helpful assistant that explains legal documents in plain, "
-                            "bite-sized bulleted chunks. Demystify technical/legal language while "
-                            "preserving the legal meaning and any obligations. Flag ambiguous parts "
-                            "or items that need human/legal review.\n\n"
-                            f"Excerpt {idx} of {len(chunks)}:\n\n{chunk}\n\n"
-                            "Task: Explain the excerpt in simple, bite-sized bullet points. "
-                            "For each bullet, indicate if it references clause numbers, parties, deadlines, "
-                            "or obligations. If a section requires special attention or a lawyer, say so. "
-                            "Finish with a short plain-English summary of the excerpt."
-                        )
-                    )
-                ],
-            )
-
-            response = client.models.generate_content(
-                model=MODEL_NAME_LEGAL, contents=[user_content]
-            )
+        prepared = await prepare_legal_document(pdf_url)
+        if prepared["cached"] is not None:
+            return prepared["cached"]
 
-            all_responses.append(response.text)
+        total = len(prepared["chunks"])
 
-        if os.path.exists(local_pdf_path):
-            os.remove(local_pdf_path)
+        async def explain_batch(batch: List[Tuple[int, str]]) -> str:
+            user_content = build_legal_content(batch, total)
+            async with _LEGAL_SEMAPHORE:
+                response = await client.aio.models.generate_content(
+                    model=MODEL_NAME_LEGAL, contents=[user_content], config=LEGAL_CONFIG
+                )
+            return response.text
 
-        combined_output = "\n\n".join(all_responses)
+        all_responses = await asyncio.gather(
+            *[explain_batch(b) for b in prepared["batches"]]
+        )
 
-        return {
-            "status": "success",
-            "explanation": combined_output,
-            "metadata": {
-                "estimated_tokens": estimated_tokens,
-                "chunks_processed": len(chunks),
-                "within_token_limit": estimated_tokens <= TOKEN_LIMIT_LEGAL,
-            },
-        }
+        result = build_legal_result(prepared, all_responses)
+        cache_put(prepared["cache_key"], result)
+        return result
 
     except Exception as e:
         return {"status": "error", "message": str(e), "explanation": None}
+
+
+async def stream_legal_document(pdf_url: str) -> AsyncIterator[Dict[str, any]]:
+    # batches stream concurrently, so every delta carries its batch number;
+    # clients concatenate deltas per batch and join batches in order
+    tasks = []
+    runner = None
+    try:
+        client = get_gemini_client()
+
+        prepared = await prepare_legal_document(pdf_url)
+        cached = prepared["cached"]
+        if cached is not None:
+            yield {"type": "delta", "batch": 1, "text": cached["explanation"]}
+            yield {"type": "done", "metadata": cached["metadata"]}
+            return
+
+        total = len(prepared["chunks"])
+        queue: "asyncio.Queue[Optional[Dict[str, any]]]" = asyncio.Queue()
+
+        async def stream_batch(n: int, batch: List[Tuple[int, str]]) -> None:
+            user_content = build_legal_content(batch, total)
+            async with _LEGAL_SEMAPHORE:
+                stream = await client.aio.models.generate_content_stream(
+                    model=MODEL_NAME_LEGAL, contents=[user_content], config=LEGAL_CONFIG
+                )
+                async for response in stream:
+                    if response.text:
+                        await queue.put({"type": "delta", "batch": n, "text": response.text})
+
+        tasks = [
+            asyncio.create_task(stream_batch(n, batch))
+            for n, batch in enumerate(prepared["batches"], start=1)
+        ]
+
+        async def close_when_done() -> None:
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                await queue.put(None)
+
+        runner = asyncio.create_task(close_when_done())
+        texts = [[] for _ in tasks]
+        while (event := await queue.get()) is not None:
+            texts[event["batch"] - 1].append(event["text"])
+            yield event
+        await runner
+
+        result = build_legal_result(prepared, ["".join(t) for t in texts])
+        cache_put(prepared["cache_key"], result)
+        yield {"type": "done", "metadata": result["metadata"]}
+
+    except Exception as e:
+        yield {"type": "error", "message": str(e)}
+    finally:
+        pending = tasks + ([runner] if runner is not None else [])
+        for task in pending:
+            task.cancel()
+        # retrieve results so failed or cancelled tasks are not logged as unretrieved
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,22 @@
+from infer import chunk_text
+
+
+def test_chunk_text_breaks_at_whitespace_within_chunk_size():
+    assert chunk_text("a b c d e f", 3) == ["a b", "c d", "e f"]
+
+
+def test_chunk_text_hard_splits_runs_without_whitespace():
+    assert chunk_text("abcdefgh", 3) == ["abc", "def", "gh"]
+
+
+def test_chunk_text_drops_empty_and_whitespace_only_text():
+    assert chunk_text("", 3) == []
+    assert chunk_text("   \n ", 3) == []
+
+
+def test_chunk_text_strips_trailing_newline():
+    assert chunk_text("abcd\n", 3) == ["abc", "d"]
+
+
+def test_chunk_text_keeps_short_text_whole():
+    assert chunk_text("short text", 30000) == ["short text"]